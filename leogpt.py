@@ -1,139 +1,276 @@
 import discord
 from discord.ext import commands
 from openai import AsyncOpenAI
+import httpx
+import aiosqlite
 import logging
+import os
 import asyncio
 import time
 from config import config
 from collections import defaultdict
-from datetime import datetime, timedelta
 
 # Configuration and Constants
-OPENAI_API_KEY = config.openai_api_key 
-DISCORD_BOT_TOKEN = config.discord_bot_token  
-ASSISTANT_ID = config.assistant_id
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', config.openai_api_key)
+DISCORD_BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN', config.discord_bot_token)
+ASSISTANT_ID = os.getenv('ASSISTANT_ID', config.assistant_id)
+DATABASE_PATH = os.getenv('DATABASE_PATH', getattr(config, 'database_path', 'leogpt.db'))
 MESSAGE_CHUNK_SIZE = config.message_chunk_size
 THREAD_INACTIVITY_TIMEOUT_HOURS = config.thread_inactivity_timeout_hours
+THREAD_INACTIVITY_TIMEOUT_SECONDS = THREAD_INACTIVITY_TIMEOUT_HOURS * 3600
+MAX_RUN_SECONDS = 1800
+OPENAI_MAX_RETRIES = 5
+MESSAGE_BATCH_DELAY_SECONDS = 0.6
+LONG_MESSAGE_BATCH_DELAY_SECONDS = 2.0
+LONG_MESSAGE_LENGTH = 1900
+THREAD_CLEANUP_INTERVAL_SECONDS = 300
+TERMINAL_RUN_STATUSES = {"completed", "failed", "cancelling", "cancelled", "expired", "incomplete"}
 
 # Setting up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # OpenAI Client Setup
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    timeout=httpx.Timeout(60.0, read=MAX_RUN_SECONDS, connect=10.0)
+)
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client, max_retries=OPENAI_MAX_RETRIES)
 
 # Discord Bot Setup
+class LeoGPTBot(commands.Bot):
+    # Open the thread database before connecting to the gateway
+    async def setup_hook(self):
+        await open_database()
+
+    # Release the database and OpenAI connections after the gateway closes
+    async def close(self):
+        await super().close()
+        await close_clients()
+
 intents = discord.Intents.default()
-bot = commands.Bot(command_prefix="!", intents=intents)
+intents.message_content = True
+bot = LeoGPTBot(
+    command_prefix="!",
+    intents=intents,
+    allowed_mentions=discord.AllowedMentions(everyone=False, roles=False)
+)
 
 # Thread Management
-thread_ids = defaultdict(lambda: {"thread_id": None, "last_used": datetime.now()})
+db = None
+thread_locks = defaultdict(asyncio.Lock)
+cleanup_task = None
+
+# Message Batching
+pending_messages = defaultdict(list)
+pending_tasks = {}
+flush_tasks = set()
+
+# Function to open the thread database
+async def open_database():
+    global db
+    db = await aiosqlite.connect(DATABASE_PATH)
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("CREATE TABLE IF NOT EXISTS threads(identifier INTEGER PRIMARY KEY, thread_id TEXT, last_used REAL)")
+    await db.execute("CREATE INDEX IF NOT EXISTS threads_last_used ON threads(last_used)")
+    await db.commit()
+    logging.info(f"Thread database opened at {DATABASE_PATH}")
+
+# Function to stop background work, then close the thread database and the OpenAI HTTP client
+async def close_clients():
+    global db, cleanup_task
+    tasks = list(flush_tasks)
+    if cleanup_task is not None:
+        tasks.append(cleanup_task)
+        cleanup_task = None
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    pending_tasks.clear()
+    pending_messages.clear()
+
+    if db is not None:
+        await db.close()
+        db = None
+        logging.info("Thread database closed")
+    if not http_client.is_closed:
+        await http_client.aclose()
+
+# Function to look up the OpenAI thread of an identifier
+async def get_thread_id(identifier):
+    async with db.execute("SELECT thread_id FROM threads WHERE identifier = ?", (identifier,)) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else None
 
 # Function to create a new thread
 async def create_new_thread(identifier):
-    global thread_ids
     try:
         thread = await openai_client.beta.threads.create()
-        thread_ids[identifier] = {"thread_id": thread.id, "last_used": datetime.now()}
+        await db.execute(
+            "INSERT INTO threads(identifier, thread_id, last_used) VALUES (?, ?, ?) "
+            "ON CONFLICT(identifier) DO UPDATE SET thread_id = excluded.thread_id, last_used = excluded.last_used",
+            (identifier, thread.id, time.time())
+        )
+        await db.commit()
         logging.info(f"New thread created for {identifier} with ID: {thread.id}")
+        return thread.id
     except Exception as e:
         logging.error(f"Error during thread creation for {identifier}: {e}")
         raise
 
+# Function to find where a message should be split to fit in a Discord chunk
+def find_split_index(message, start=0):
+    end = start + MESSAGE_CHUNK_SIZE
+    if end >= len(message):
+        return len(message)
+    split_index = message.rfind('\n\n', start + MESSAGE_CHUNK_SIZE // 2, end)
+    if split_index != -1:
+        return split_index + 2
+    split_index = message.rfind(' ', start, end)
+    if split_index > start:
+        return split_index + 1
+    return end
+
+# Function to split a message into Discord-sized chunks
+def split_message(message):
+    start = 0
+    while start < len(message):
+        split_index = find_split_index(message, start)
+        chunk = message[start:split_index].strip()
+        if chunk:
+            yield chunk
+        start = split_index
+
 # Function to send messages in chunks
 async def send_in_chunks(channel, message):
     logging.info("Sending message in chunks")
     try:
-        while message:
-            split_index = (message.rfind(' ', 0, MESSAGE_CHUNK_SIZE) + 1) if len(message) > MESSAGE_CHUNK_SIZE else len(message)
-            chunk = message[:split_index].strip()
-            await channel.send(chunk)
-            message = message[split_index:]
+        for chunk in split_message(message):
+            await channel.send(chunk, suppress_embeds=True)
         logging.info("All chunks sent successfully")
     except Exception as e:
         logging.error(f"Error sending message in chunks: {e}")
         raise
 
-# Function to send message to OpenAI
-async def send_message_to_openai(clean_message, thread_id):
+# Function to cancel a streamed run that is still active on OpenAI's side
+async def cancel_active_run(stream, thread_id):
+    run = stream.current_run
+    if run is None or run.status in TERMINAL_RUN_STATUSES:
+        return
     try:
-        await openai_client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=clean_message
-        )
+        await openai_client.beta.threads.runs.cancel(run.id, thread_id=thread_id)
+        logging.info(f"Cancelled run {run.id} on thread {thread_id}")
     except Exception as e:
-        logging.error(f"Error sending message to OpenAI: {e}")
-        raise
+        logging.error(f"Error cancelling run {run.id}: {e}")
 
-# Function to check OpenAI response
-async def check_openai_response(thread_id, run_id):
-    try:
-        start_time = time.time()
-        while True:
-            updated_run = await openai_client.beta.threads.runs.retrieve(
-                thread_id=thread_id,
-                run_id=run_id
-            )
-            if updated_run.status == "completed":
-                break
-
-            elapsed_time = time.time() - start_time
-            sleep_time = min(1 + elapsed_time / 10, 5)
-            await asyncio.sleep(sleep_time)
-    except Exception as e:
-        logging.error(f"Error checking OpenAI response: {e}")
-        raise
+# Function to relay a run's streamed text to a channel in Discord-sized chunks
+async def relay_openai_stream(stream, channel):
+    deltas = []
+    buffer = ""
+    async for delta in stream.text_deltas:
+        deltas.append(delta)
+        buffer += delta
+        while len(buffer) > MESSAGE_CHUNK_SIZE:
+            split_index = find_split_index(buffer)
+            await send_in_chunks(channel, buffer[:split_index])
+            buffer = buffer[split_index:]
+    run = await stream.get_final_run()
+
+    if run.status != "completed":
+        raise RuntimeError(f"Run {run.id} ended with status '{run.status}'")
+
+    return "".join(deltas), buffer
 
-# Function to retrieve the latest response from OpenAI
-async def retrieve_latest_response(thread_id):
+# Function to send a message to OpenAI and stream the assistant's response to a channel
+async def stream_openai_response(clean_message, thread_id, channel):
     try:
-        messages = await openai_client.beta.threads.messages.list(thread_id=thread_id)
-        assistant_messages = [msg for msg in messages.data if msg.role == "assistant"]
-        if assistant_messages:
-            latest_message = max(assistant_messages, key=lambda x: x.created_at)
-            return latest_message.content[0].text.value
-        else:
-            return "No response from the assistant."
+        async with openai_client.beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=ASSISTANT_ID,
+            additional_messages=[{"role": "user", "content": clean_message}]
+        ) as stream:
+            try:
+                response, buffer = await asyncio.wait_for(relay_openai_stream(stream, channel), timeout=MAX_RUN_SECONDS)
+            except BaseException:
+                await cancel_active_run(stream, thread_id)
+                raise
+
+        if not response:
+            response = buffer = "No response from the assistant."
+        await send_in_chunks(channel, buffer)
+        return response
     except Exception as e:
-        logging.error(f"Error retrieving response from OpenAI: {e}")
+        logging.error(f"Error streaming response from OpenAI: {e}")
         raise
 
 # Function to interact with OpenAI
-async def interact_with_openai(clean_message, identifier):
-    global thread_ids
-    thread_info = thread_ids[identifier]
-    thread_id = thread_info["thread_id"]
-    if thread_id is None:
-        await create_new_thread(identifier)
-        thread_id = thread_ids[identifier]["thread_id"]
+async def interact_with_openai(clean_message, identifier, channel):
+    async with thread_locks[identifier]:
+        thread_id = await get_thread_id(identifier)
+        if thread_id is None:
+            thread_id = await create_new_thread(identifier)
 
-    try:
-        await send_message_to_openai(clean_message, thread_id)
+        try:
+            return await stream_openai_response(clean_message, thread_id, channel)
 
-        run = await openai_client.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=ASSISTANT_ID
-        )
+        except Exception as e:
+            logging.error(f"Error during OpenAI interaction: {e}")
+            response = "I'm having trouble processing your request right now."
+            await send_in_chunks(channel, response)
+            return response
 
-        await check_openai_response(thread_id, run.id)
-        return await retrieve_latest_response(thread_id)
+# Function to answer the messages batched for a channel and author once they go quiet
+async def flush_pending_messages(channel, batch_key, delay):
+    await asyncio.sleep(delay)
+    pending_tasks.pop(batch_key, None)
+    clean_message = "\n".join(pending_messages.pop(batch_key, []))
+    identifier = channel.id
 
+    try:
+        async with channel.typing():
+            response = await interact_with_openai(clean_message, identifier, channel)
+            logging.info(f"OpenAI response: {response}")
     except Exception as e:
-        logging.error(f"Error during OpenAI interaction: {e}")
-        return "I'm having trouble processing your request right now."
+        logging.error(f"Error flushing pending messages for {identifier}: {e}")
+
+# Function to mark a thread as used
+async def touch_thread(identifier):
+    await db.execute(
+        "INSERT INTO threads(identifier, last_used) VALUES (?, ?) "
+        "ON CONFLICT(identifier) DO UPDATE SET last_used = excluded.last_used",
+        (identifier, time.time())
+    )
+    await db.commit()
 
 # Function for cleaning up old threads
-def cleanup_old_threads():
-    now = datetime.now()
-    for key, value in list(thread_ids.items()):
-        if now - value["last_used"] > timedelta(hours=THREAD_INACTIVITY_TIMEOUT_HOURS):
-            del thread_ids[key]
+async def cleanup_old_threads():
+    cutoff = time.time() - THREAD_INACTIVITY_TIMEOUT_SECONDS
+    expired = await db.execute_fetchall("SELECT identifier FROM threads WHERE last_used < ?", (cutoff,))
+    await db.execute("DELETE FROM threads WHERE last_used < ?", (cutoff,))
+    await db.commit()
+    for (key,) in expired:
+        lock = thread_locks.get(key)
+        if lock is not None and not lock.locked():
+            del thread_locks[key]
+
+# Function to periodically clean up old threads in the background
+async def cleanup_old_threads_periodically():
+    while True:
+        await asyncio.sleep(THREAD_CLEANUP_INTERVAL_SECONDS)
+        try:
+            await cleanup_old_threads()
+        except Exception as e:
+            logging.error(f"Error cleaning up old threads: {e}")
 
 # Bot event: on_ready
 @bot.event
 async def on_ready():
+    global cleanup_task
     try:
         logging.info(f"Logged in as {bot.user.name}")
+        if cleanup_task is None:
+            cleanup_task = asyncio.create_task(cleanup_old_threads_periodically())
     except Exception as e:
         logging.error(f"Error in on_ready: {e}")
 
@@ -141,26 +278,33 @@ async def on_ready():
 @bot.event
 async def on_message(message):
     try:
-        if message.author == bot.user:
+        if message.author == bot.user or message.mention_everyone:
+            return
+
+        # Follow-ups from an author with a pending batch join it even without a mention
+        batch_key = (message.channel.id, message.author.id)
+        if bot.user not in message.mentions and batch_key not in pending_tasks:
             return
 
-        identifier = message.channel.id 
-        thread_ids[identifier]["last_used"] = datetime.now()
+        identifier = message.channel.id
+        await touch_thread(identifier)
 
-        cleanup_old_threads()
+        clean_message = discord.utils.remove_markdown(message.clean_content)
+        logging.info(f"Received message from {message.author.name}: {clean_message}")
 
-        bot_mention = f'<@{bot.user.id}>'
-        if message.content.startswith(bot_mention):
-            clean_message = discord.utils.remove_markdown(message.clean_content)
-            logging.info(f"Received message from {message.author.name}: {clean_message}")
+        pending_messages[batch_key].append(clean_message)
+        pending_task = pending_tasks.get(batch_key)
+        if pending_task is not None:
+            pending_task.cancel()
 
-            async with message.channel.typing():
-                response = await interact_with_openai(clean_message, identifier)
-                logging.info(f"OpenAI response: {response}")
-            
-            await send_in_chunks(message.channel, response)
+        delay = LONG_MESSAGE_BATCH_DELAY_SECONDS if len(message.content) >= LONG_MESSAGE_LENGTH else MESSAGE_BATCH_DELAY_SECONDS
+        flush_task = asyncio.create_task(flush_pending_messages(message.channel, batch_key, delay))
+        flush_tasks.add(flush_task)
+        flush_task.add_done_callback(flush_tasks.discard)
+        pending_tasks[batch_key] = flush_task
     except Exception as e:
         logging.error(f"Error in on_message for {message.content}: {e}")
 
 # Running the bot
-bot.run(DISCORD_BOT_TOKEN)
+if __name__ == "__main__":
+    bot.run(DISCORD_BOT_TOKEN)